@@ -0,0 +1,87 @@
+"""
+Resolve post authors in one batched lookup, with an LRU cache shared across calls.
+
+User names almost never change, so both report paths keep their resolver at
+module level and only hit the database for ids they have not seen recently:
+
+    authors = sql_author_resolver.resolve(post.user_id for post in posts)
+    authors[post.user_id]  # {"id": 1, "name": "..."}
+"""
+
+import threading
+from collections import OrderedDict
+from collections.abc import Callable, Hashable, Iterable, Mapping
+
+
+def load_sql_authors(user_ids: Iterable[int]) -> dict[int, tuple[int, str]]:
+    from sqlalchemy import select
+    from sqlalchemy.orm import Session
+    from sql_db.db_config import engine
+    from sql_db.models import User
+
+    stmt = select(User.id, User.name).where(User.id.in_(user_ids))
+    with Session(engine) as session:
+        return {uid: (uid, name) for uid, name in session.execute(stmt).all()}
+
+
+def load_mongo_authors(user_oids: Iterable) -> dict:
+    import mongo_db  # noqa: F401
+    from mongo_db.models import User
+
+    users = User._get_collection().find(
+        {"_id": {"$in": list(user_oids)}},
+        {"sql_id": True, "name": True},
+    )
+    return {u["_id"]: (u["sql_id"], u["name"]) for u in users}
+
+
+class AuthorResolver:
+    def __init__(
+        self,
+        load_func: Callable[[Iterable[Hashable]], Mapping[Hashable, tuple[int, str]]],
+        maxsize: int = 10_000,
+    ):
+        self.load_func = load_func
+        self.maxsize = maxsize
+        self._cache: OrderedDict[Hashable, tuple[int, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def resolve(self, keys: Iterable[Hashable]) -> dict[Hashable, dict]:
+        """
+        Return `{key: {"id": ..., "name": ...}}` for every known key.
+        Keys missing from the cache are loaded with a single `load_func` call.
+        """
+        found, missing = {}, []
+
+        with self._lock:
+            for key in set(keys):
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    found[key] = self._cache[key]
+                else:
+                    missing.append(key)
+
+        if missing:
+            loaded = self.load_func(missing)
+            found.update(loaded)
+
+            with self._lock:
+                self._cache.update(loaded)
+                for key in loaded:
+                    self._cache.move_to_end(key)
+                while len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+
+        return {key: {"id": uid, "name": name} for key, (uid, name) in found.items()}
+
+    def invalidate(self, key: Hashable = None):
+        """Forget `key`, e.g. after a user is renamed, or everything if not given."""
+        with self._lock:
+            if key is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(key, None)
+
+
+sql_author_resolver = AuthorResolver(load_sql_authors)
+mongo_author_resolver = AuthorResolver(load_mongo_authors)
@@ -0,0 +1,431 @@
+"""
+Simulate production traffic against the seeded data.
+
+A weighted mix of view increments, post likes, comment likes, new comments and
+report reads is run against the SQL schema, the Mongo schema, or both, and
+throughput, latency percentiles and ok / conflict / error counts are reported
+per operation.
+
+With `--rate` the load is open-loop: operations arrive as a Poisson process
+regardless of how fast earlier ones complete, and latency is measured from the
+scheduled arrival time, so queueing delay is included. Without it, `--concurrency`
+workers run operations back to back (closed-loop).
+
+    python load_generator.py --target both --rate 200 --duration 30 \\
+        --mix view=70,post_like=10,comment_like=8,comment=7,report=5
+
+Note the SQL engine's connection pool (5 + 10 overflow by default) also bounds
+how many SQL operations can be in flight.
+"""
+
+import argparse
+import math
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import Counter, defaultdict
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+from faker import Faker
+
+from view_counter import ViewCounter, flush_mongo, flush_sql
+
+fake = Faker(locale="zh_tw")
+
+DEFAULT_MIX = {
+    "view": 70,
+    "post_like": 10,
+    "comment_like": 8,
+    "comment": 7,
+    "report": 5,
+}
+
+
+class Conflict(Exception):
+    """The write was rejected because it already happened, e.g. a duplicated like."""
+
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.outcomes: dict[str, Counter] = defaultdict(Counter)
+        self.errors: Counter = Counter()
+
+    def record(self, op: str, latency: float, outcome: str, exc: Exception = None):
+        with self._lock:
+            self.latencies[op].append(latency)
+            self.outcomes[op][outcome] += 1
+            if exc is not None:
+                self.errors[f"{op}: {type(exc).__name__}"] += 1
+
+
+class Workload(ABC):
+    name: str
+    # Loaded by setup()
+    post_ids: list[int]
+
+    def __init__(self, skew: float = 1.0, view_counter: ViewCounter = None):
+        # skew > 1 concentrates traffic on the first posts, to simulate hot posts
+        self.skew = skew
+        # when given, views are buffered in the counter instead of written one by one
+        self.view_counter = view_counter
+
+    def pick_post(self, rng: random.Random, post_ids: list[int]) -> int:
+        return post_ids[int(len(post_ids) * rng.random() ** self.skew)]
+
+    @abstractmethod
+    def setup(self):
+        """Load the ids the operations pick from."""
+
+    @abstractmethod
+    def incr_views(self, post_id: int):
+        """Write one view of `post_id` straight to the store."""
+
+    @abstractmethod
+    def post_like(self, rng: random.Random):
+        """Like a post, `Conflict` if the user already liked it."""
+
+    @abstractmethod
+    def comment_like(self, rng: random.Random):
+        """Like a comment, `Conflict` if the user already liked it."""
+
+    @abstractmethod
+    def comment(self, rng: random.Random):
+        """Add a comment to a post."""
+
+    @abstractmethod
+    def report(self, rng: random.Random):
+        """Run the June report of `query_demo`."""
+
+    def view(self, rng: random.Random):
+        post_id = self.pick_post(rng, self.post_ids)
+        if self.view_counter is not None:
+            self.view_counter.incr(post_id)
+        else:
+            self.incr_views(post_id)
+
+    @property
+    def ops(self) -> dict[str, Callable[[random.Random], None]]:
+        return {
+            "view": self.view,
+            "post_like": self.post_like,
+            "comment_like": self.comment_like,
+            "comment": self.comment,
+            "report": self.report,
+        }
+
+
+class SqlWorkload(Workload):
+    name = "sql"
+
+    # MySQL error code of a unique constraint violation
+    DUPLICATE_ENTRY = 1062
+
+    def setup(self):
+        from sqlalchemy import select
+        from sqlalchemy.orm import Session
+        from sql_db.db_config import engine
+        from sql_db.models import User, Post, Comment
+
+        with Session(engine) as session:
+            self.user_ids = session.scalars(select(User.id)).all()
+            self.post_ids = session.scalars(select(Post.id).order_by(Post.id)).all()
+            self.comment_ids = session.scalars(select(Comment.id)).all()
+
+    def _commit(self, session):
+        from sqlalchemy.exc import IntegrityError
+
+        try:
+            session.commit()
+        except IntegrityError as e:
+            session.rollback()
+            if e.orig.args[0] == self.DUPLICATE_ENTRY:
+                raise Conflict(str(e.orig)) from e
+            raise
+
+    def incr_views(self, post_id: int):
+        from sqlalchemy import update
+        from sqlalchemy.orm import Session
+        from sql_db.db_config import engine
+        from sql_db.models import Post
+
+        with Session(engine) as session:
+            session.execute(
+                update(Post).where(Post.id == post_id).values(views=Post.views + 1)
+            )
+            session.commit()
+
+    def post_like(self, rng: random.Random):
+        from sqlalchemy.orm import Session
+        from sql_db.db_config import engine
+        from sql_db.models import PostLike
+
+        post_id = self.pick_post(rng, self.post_ids)
+        with Session(engine) as session:
+            session.add(PostLike(user_id=rng.choice(self.user_ids), post_id=post_id))
+            self._commit(session)
+
+    def comment_like(self, rng: random.Random):
+        from sqlalchemy.orm import Session
+        from sql_db.db_config import engine
+        from sql_db.models import CommentLike
+
+        with Session(engine) as session:
+            session.add(
+                CommentLike(
+                    user_id=rng.choice(self.user_ids),
+                    comment_id=rng.choice(self.comment_ids),
+                )
+            )
+            self._commit(session)
+
+    def comment(self, rng: random.Random):
+        from sqlalchemy.orm import Session
+        from sql_db.db_config import engine
+        from sql_db.models import Comment
+
+        post_id = self.pick_post(rng, self.post_ids)
+        with Session(engine) as session:
+            session.add(
+                Comment(
+                    post_id=post_id,
+                    user_id=rng.choice(self.user_ids),
+                    body=fake.sentence(),
+                )
+            )
+            self._commit(session)
+
+    def report(self, rng: random.Random):
+        from query_demo import sql_query
+
+        sql_query()
+
+
+class MongoWorkload(Workload):
+    name = "mongo"
+
+    def setup(self):
+        import mongo_db  # noqa: F401
+        from mongo_db.models import User, Post
+
+        self.user_ids = list(User.objects.scalar("id"))
+        # fmt: off
+        posts = list(Post.objects.aggregate([
+            {"$project": {"_id": False, "sql_id": True, "comment_count": {"$size": "$comments"}}},
+            {"$sort": {"sql_id": 1}},
+        ]))
+        # fmt: on
+        self.post_ids = [p["sql_id"] for p in posts]
+        self.comment_counts = {p["sql_id"]: p["comment_count"] for p in posts}
+        self.commented_post_ids = [p["sql_id"] for p in posts if p["comment_count"]]
+
+    def incr_views(self, post_id: int):
+        from mongo_db.models import Post
+
+        Post.objects(sql_id=post_id).update_one(inc__views=1)
+
+    def post_like(self, rng: random.Random):
+        from mongo_db.models import Post
+
+        result = Post.objects(sql_id=self.pick_post(rng, self.post_ids)).update_one(
+            add_to_set__likes=rng.choice(self.user_ids), full_result=True
+        )
+        if not result.modified_count:
+            raise Conflict("post already liked by user")
+
+    def comment_like(self, rng: random.Random):
+        from mongo_db.models import Post
+
+        post_id = self.pick_post(rng, self.commented_post_ids)
+        idx = rng.randrange(self.comment_counts[post_id])
+        result = Post._get_collection().update_one(
+            {"sql_id": post_id},
+            {"$addToSet": {f"comments.{idx}.likes": rng.choice(self.user_ids)}},
+        )
+        if not result.modified_count:
+            raise Conflict("comment already liked by user")
+
+    def comment(self, rng: random.Random):
+        from mongo_db.models import Post
+
+        Post.objects(sql_id=self.pick_post(rng, self.post_ids)).update_one(
+            push__comments=Post.Comment(
+                user=rng.choice(self.user_ids), body=fake.sentence()
+            )
+        )
+
+    def report(self, rng: random.Random):
+        from query_demo import mongo_query
+
+        mongo_query()
+
+
+def _run_op(workload: Workload, op: str, rng: random.Random, start: float, stats: Stats):
+    try:
+        workload.ops[op](rng)
+    except Conflict:
+        stats.record(op, time.perf_counter() - start, "conflict")
+    except Exception as e:
+        stats.record(op, time.perf_counter() - start, "error", e)
+    else:
+        stats.record(op, time.perf_counter() - start, "ok")
+
+
+def run_open_loop(
+    workloads: list[Workload],
+    mix: dict[str, int],
+    rate: float,
+    duration: float,
+    concurrency: int,
+    rng: random.Random,
+) -> dict[str, Stats]:
+    stats = {w.name: Stats() for w in workloads}
+    ops, weights = list(mix), list(mix.values())
+
+    with ThreadPoolExecutor(max_workers=concurrency * len(workloads)) as executor:
+        arrival = time.perf_counter()
+        end = arrival + duration
+
+        while arrival < end:
+            if (delay := arrival - time.perf_counter()) > 0:
+                time.sleep(delay)
+
+            op = rng.choices(ops, weights)[0]
+            for w in workloads:
+                op_rng = random.Random(rng.random())
+                executor.submit(_run_op, w, op, op_rng, arrival, stats[w.name])
+
+            arrival += rng.expovariate(rate)
+
+    return stats
+
+
+def run_closed_loop(
+    workloads: list[Workload],
+    mix: dict[str, int],
+    duration: float,
+    concurrency: int,
+    rng: random.Random,
+) -> dict[str, Stats]:
+    stats = {w.name: Stats() for w in workloads}
+    ops, weights = list(mix), list(mix.values())
+    end = time.perf_counter() + duration
+
+    def _worker(workload: Workload, worker_rng: random.Random):
+        while time.perf_counter() < end:
+            op = worker_rng.choices(ops, weights)[0]
+            _run_op(workload, op, worker_rng, time.perf_counter(), stats[workload.name])
+
+    with ThreadPoolExecutor(max_workers=concurrency * len(workloads)) as executor:
+        for w in workloads:
+            for _ in range(concurrency):
+                executor.submit(_worker, w, random.Random(rng.random()))
+
+    return stats
+
+
+def percentile(sorted_values: list[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    idx = max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)
+    return sorted_values[idx]
+
+
+def report(name: str, stats: Stats, elapsed: float):
+    total = sum(len(v) for v in stats.latencies.values())
+    print(f"[{name}] {total} ops in {elapsed:.2f}s ({total / elapsed:.1f} ops/s)")
+    print(
+        f"{'op':<14}{'count':>8}{'ok':>8}{'conflict':>10}{'error':>8}"
+        f"{'ops/s':>10}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}  (ms)"
+    )
+
+    for op, latencies in sorted(stats.latencies.items()):
+        latencies = sorted(lat * 1000 for lat in latencies)
+        outcomes = stats.outcomes[op]
+        print(
+            f"{op:<14}{len(latencies):>8}{outcomes['ok']:>8}"
+            f"{outcomes['conflict']:>10}{outcomes['error']:>8}"
+            f"{len(latencies) / elapsed:>10.1f}"
+            f"{percentile(latencies, 50):>9.1f}{percentile(latencies, 95):>9.1f}"
+            f"{percentile(latencies, 99):>9.1f}{latencies[-1]:>9.1f}"
+        )
+
+    for error, cnt in stats.errors.most_common():
+        print(f"  {cnt} x {error}")
+    print()
+
+
+def parse_mix(value: str) -> dict[str, int]:
+    mix = {}
+    for item in value.split(","):
+        op, _, weight = item.partition("=")
+        if op not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"unknown operation: {op}")
+        mix[op] = int(weight)
+    return {op: weight for op, weight in mix.items() if weight > 0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--target", choices=("sql", "mongo", "both"), default="both")
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default=DEFAULT_MIX,
+        help="comma separated op=weight, ops: " + ", ".join(DEFAULT_MIX),
+    )
+    parser.add_argument(
+        "--rate", type=float, default=0, help="arrivals per second, 0 for closed-loop"
+    )
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--concurrency", type=int, default=8, help="workers per target")
+    parser.add_argument("--skew", type=float, default=1.0, help="hot post skew, >= 1")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument(
+        "--buffer-views",
+        type=float,
+        default=0,
+        metavar="SECONDS",
+        help="buffer view increments and flush them every SECONDS, 0 to disable",
+    )
+    args = parser.parse_args()
+
+    def _view_counter(flush_func):
+        if args.buffer_views > 0:
+            return ViewCounter(flush_func, interval=args.buffer_views)
+
+    workloads: list[Workload] = []
+    if args.target in ("sql", "both"):
+        workloads.append(SqlWorkload(args.skew, _view_counter(flush_sql)))
+    if args.target in ("mongo", "both"):
+        workloads.append(MongoWorkload(args.skew, _view_counter(flush_mongo)))
+
+    for w in workloads:
+        w.setup()
+
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    if args.rate > 0:
+        results = run_open_loop(
+            workloads, args.mix, args.rate, args.duration, args.concurrency, rng
+        )
+    else:
+        results = run_closed_loop(
+            workloads, args.mix, args.duration, args.concurrency, rng
+        )
+    elapsed = time.perf_counter() - start
+
+    for w in workloads:
+        if w.view_counter is not None:
+            w.view_counter.close()
+            if w.view_counter.dropped:
+                print(f"[{w.name}] {w.view_counter.dropped} buffered views dropped")
+
+    for name, stats in results.items():
+        report(name, stats, elapsed)
+
+
+if __name__ == "__main__":
+    main()
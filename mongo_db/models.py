@@ -34,6 +34,8 @@ class Post(Document):
     title = StringField(max_length=200, required=True)
     body = StringField(required=True)
     views = IntField(min_value=0, default=0)
+    # Last view counter batches applied, so a retried batch is not counted twice
+    view_batches = ListField(StringField(max_length=32))
     likes = ListField(field=ObjectIdField())
     comments = EmbeddedDocumentListField(Comment)
     tags = ListField(StringField(max_length=50))
@@ -44,5 +46,7 @@ class Post(Document):
         "index_background": True,
         "indexes": [
             {"fields": ["tags"]},
+            # Posts commented since the last search index update
+            {"fields": ["comments.created_at"]},
         ],
     }
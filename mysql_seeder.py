@@ -2,12 +2,21 @@ from functools import wraps
 from datetime import datetime, timedelta
 from collections.abc import Sequence
 from faker import Faker
-from sqlalchemy import select
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import Session, load_only
+from sqlalchemy import Select, select, func
+from sqlalchemy.orm import InstrumentedAttribute, Session, load_only
 
 from sql_db.db_config import engine
-from sql_db.models import Base, User, Tag, Post, PostLike, PostTag, Comment, CommentLike
+from sql_db.models import (
+    Base,
+    User,
+    Tag,
+    Post,
+    PostLike,
+    PostTag,
+    Comment,
+    CommentLike,
+    SeedCheckpoint,
+)
 
 fake = Faker(locale="zh_tw")
 
@@ -53,28 +62,101 @@ def transaction(func):
     return _inner
 
 
+def get_checkpoint(session: Session, stage: str, **initial: Select) -> SeedCheckpoint:
+    """
+    Return the checkpoint of `stage`, creating it if there is none. Stages update
+    it and commit it along with each batch, so a crash never leaves a batch
+    persisted without its checkpoint (or vice versa).
+
+    A missing checkpoint does not mean the stage never ran (e.g. a database seeded
+    before checkpoints existed), so its fields are initialized from the data
+    already there, with the scalar statements given in `initial`:
+
+        get_checkpoint(session, "post_likes", last_id=seeded_up_to(Post.id, PostLike.id))
+    """
+    stmt = select(SeedCheckpoint).where(SeedCheckpoint.stage == stage)
+    if (checkpoint := session.scalar(stmt)) is None:
+        checkpoint = SeedCheckpoint(stage=stage, last_id=0)
+        for field, value_stmt in initial.items():
+            if (value := session.scalar(value_stmt)) is not None:
+                setattr(checkpoint, field, value)
+        session.add(checkpoint)
+        # Right away, even if the stage has nothing left to do, so later rows are
+        # not mistaken for data seeded before the checkpoint
+        session.commit()
+    return checkpoint
+
+
+def seeded_up_to(source_id: InstrumentedAttribute, seeded_id: InstrumentedAttribute) -> Select:
+    """
+    `max(source_id)` if the table of `seeded_id` has any row, NULL otherwise.
+
+    Rows of a stage are optional per post (a post may get no like or comment),
+    so the last post having rows says nothing about the posts after it: a stage
+    that has rows at all counts as done for every existing post.
+    """
+    return select(func.max(source_id)).where(select(seeded_id).exists())
+
+
+def date_after(created_at: datetime):
+    """Random date between `created_at` and now, or `created_at` if it is in the future."""
+    return fake.date_between(created_at, max(created_at, datetime.now()))
+
+
+def iter_batches(
+    session: Session,
+    stmt: Select,
+    id_column: InstrumentedAttribute,
+    checkpoint: SeedCheckpoint,
+    step: int,
+):
+    """
+    Keyset-paginate `stmt` over rows whose id is past `checkpoint.last_id`.
+    The caller is expected to advance the checkpoint before fetching the next batch.
+    """
+    while True:
+        batch_stmt = (
+            stmt.where(id_column > checkpoint.last_id)
+            .order_by(id_column.asc())
+            .limit(step)
+        )
+
+        if not (rows := session.scalars(batch_stmt).all()):
+            break
+
+        yield rows
+
+
 @transaction
 def generate_users(num: int, session: Session = None):
-    for idx in range(0, num, 100):
+    """Make sure `num` users exist, creating only the missing ones."""
+    checkpoint = get_checkpoint(session, "users", last_id=select(func.max(User.id)))
+    existing = session.scalar(select(func.count(User.id)))
+
+    for idx in range(existing, num, 100):
         gen_num = 100 if num - idx > 100 else num - idx
-        users = (User(name=fake.name()) for _ in range(gen_num))
+        users = [User(name=fake.name()) for _ in range(gen_num)]
         session.add_all(users)
+        session.flush()
+
+        checkpoint.last_id = users[-1].id
         session.commit()
 
-        print(f"{(idx + 100)} users created...")
+        print(f"{(idx + gen_num)} users created...")
 
     print("User generation complete.")
 
 
 @transaction
 def generate_tags(session: Session = None):
-    for name in tag_names:
-        try:
-            session.add(Tag(name=name))
-            session.commit()
-        except IntegrityError:
-            session.rollback()
-            continue
+    checkpoint = get_checkpoint(session, "tags", last_id=select(func.max(Tag.id)))
+    existing = set(session.scalars(select(Tag.name)).all())
+
+    session.add_all(Tag(name=name) for name in tag_names if name not in existing)
+    session.flush()
+
+    checkpoint.last_id = session.scalar(select(func.max(Tag.id))) or 0
+    session.commit()
 
     print("Tag generation complete.")
     return
@@ -84,12 +166,26 @@ def generate_tags(session: Session = None):
 def generate_posts(
     user_ids: Sequence[int] = None,
     max_post_num_for_each_user: int = 10,
+    months: int = 3,
+    extra_months: int = 0,
     session: Session = None,
 ):
+    """
+    Generate posts in 30-day windows, starting `months` windows ago on the first run.
+    Later runs continue from the last finished window up to now, and `extra_months`
+    asks for at least that many more windows, even if they end in the future.
+    """
     if not user_ids:
         user_ids = session.scalars(select(User.id)).all()
 
+    checkpoint = get_checkpoint(
+        session,
+        "posts",
+        last_id=select(func.max(Post.id)),
+        watermark=select(func.max(Post.created_at)),
+    )
     now = datetime.now()
+    window = timedelta(days=30)
 
     def _generate_posts(
         start_from: datetime,
@@ -106,10 +202,11 @@ def generate_posts(
                     created_at=fake.date_between(start_from, end_at),
                 )
 
-    # Generate post across 3 month
-    for idx in range(3, 0, -1):
-        start = now - timedelta(days=30 * idx)
-        end = now - timedelta(days=30 * (idx - 1))
+    start = checkpoint.watermark or now - window * months
+    until = max(now, start + window * extra_months)
+
+    while start + window <= until:
+        end = start + window
 
         posts = sorted(
             _generate_posts(start, end),
@@ -117,18 +214,28 @@ def generate_posts(
         )
 
         session.add_all(posts)
+        session.flush()
+
+        # The window and its checkpoint are committed together
+        checkpoint.watermark = end
+        checkpoint.last_id = posts[-1].id if posts else checkpoint.last_id
         session.commit()
 
         print(
             f"{len(posts)} posts from {start.isoformat()} to {end.isoformat()} created..."
         )
 
+        start = end
+
     print("Post generation complete.")
 
 
 @transaction
 def generate_post_likes(session: Session = None):
     user_ids = session.scalars(select(User.id)).all()
+    checkpoint = get_checkpoint(
+        session, "post_likes", last_id=seeded_up_to(Post.id, PostLike.id)
+    )
 
     def _generate_likes(
         posts: Sequence[Post],
@@ -141,31 +248,21 @@ def generate_post_likes(session: Session = None):
                 PostLike(
                     user_id=uid,
                     post_id=p.id,
-                    created_at=fake.date_between(p.created_at, datetime.now()),
+                    created_at=date_after(p.created_at),
                 )
                 for uid in like_users
             )
 
-    post_stmt = (
-        select(Post)
-        .options(load_only(Post.id, Post.views, Post.created_at, raiseload=True))
-        .order_by(Post.id.asc())
+    post_stmt = select(Post).options(
+        load_only(Post.id, Post.views, Post.created_at, raiseload=True)
     )
-    offset = 0
     step = 20
 
-    while True:
-        stmt = post_stmt.offset(offset).limit(step)
-        posts = session.scalars(stmt).all()
-
-        if not len(posts):
-            break
-
+    for posts in iter_batches(session, post_stmt, Post.id, checkpoint, step):
         session.add_all(_generate_likes(posts))
+        checkpoint.last_id = posts[-1].id
         session.commit()
-        print(f"Likes of {offset + len(posts)} posts created...")
-
-        offset += step
+        print(f"Likes of posts up to #{checkpoint.last_id} created...")
 
     print("PostLike generation complete.")
 
@@ -173,6 +270,9 @@ def generate_post_likes(session: Session = None):
 @transaction
 def generate_post_tags(session: Session):
     tag_ids = session.scalars(select(Tag.id)).all()
+    checkpoint = get_checkpoint(
+        session, "post_tags", last_id=seeded_up_to(Post.id, PostTag.id)
+    )
 
     def _generate_tags(
         posts: Sequence[Post],
@@ -188,26 +288,16 @@ def generate_post_tags(session: Session):
                 for tag_id in fake.random_sample(tag_ids, cnt)
             )
 
-    post_stmt = (
-        select(Post)
-        .options(load_only(Post.id, Post.created_at, raiseload=True))
-        .order_by(Post.id.asc())
+    post_stmt = select(Post).options(
+        load_only(Post.id, Post.created_at, raiseload=True)
     )
-    offset = 0
     step = 50
 
-    while True:
-        stmt = post_stmt.offset(offset).limit(step)
-        posts = session.scalars(stmt).all()
-
-        if not len(posts):
-            break
-
+    for posts in iter_batches(session, post_stmt, Post.id, checkpoint, step):
         session.add_all(_generate_tags(posts))
+        checkpoint.last_id = posts[-1].id
         session.commit()
-        print(f"Tags of {offset + len(posts)} posts created...")
-
-        offset += step
+        print(f"Tags of posts up to #{checkpoint.last_id} created...")
 
     print("PostTag generation complete.")
 
@@ -215,6 +305,9 @@ def generate_post_tags(session: Session):
 @transaction
 def generate_post_comments(session: Session):
     user_ids = session.scalars(select(User.id)).all()
+    checkpoint = get_checkpoint(
+        session, "post_comments", last_id=seeded_up_to(Post.id, Comment.id)
+    )
 
     def _generate_comments(
         posts: Sequence[Post],
@@ -228,31 +321,21 @@ def generate_post_comments(session: Session):
                     post_id=p.id,
                     user_id=uid,
                     body=fake.sentence(),
-                    created_at=fake.date_between(p.created_at, datetime.now()),
+                    created_at=date_after(p.created_at),
                 )
                 for uid in comment_users
             )
 
-    post_stmt = (
-        select(Post)
-        .options(load_only(Post.id, Post.created_at, raiseload=True))
-        .order_by(Post.id.asc())
+    post_stmt = select(Post).options(
+        load_only(Post.id, Post.created_at, raiseload=True)
     )
-    offset = 0
     step = 10
 
-    while True:
-        stmt = post_stmt.offset(offset).limit(step)
-        posts = session.scalars(stmt).all()
-
-        if not len(posts):
-            break
-
+    for posts in iter_batches(session, post_stmt, Post.id, checkpoint, step):
         session.add_all(_generate_comments(posts))
+        checkpoint.last_id = posts[-1].id
         session.commit()
-        print(f"Comments of {offset + len(posts)} posts created...")
-
-        offset += step
+        print(f"Comments of posts up to #{checkpoint.last_id} created...")
 
     print("PostComment generation complete.")
 
@@ -260,6 +343,9 @@ def generate_post_comments(session: Session):
 @transaction
 def generate_post_comment_likes(session: Session = None):
     user_ids = session.scalars(select(User.id)).all()
+    checkpoint = get_checkpoint(
+        session, "comment_likes", last_id=seeded_up_to(Comment.id, CommentLike.id)
+    )
 
     def _generate_comment_likes(
         comments: Sequence[Comment],
@@ -274,41 +360,37 @@ def generate_post_comment_likes(session: Session = None):
                 CommentLike(
                     user_id=uid,
                     comment_id=c.id,
-                    created_at=fake.date_between(c.created_at, datetime.now()),
+                    created_at=date_after(c.created_at),
                 )
                 for uid in fake.random_sample(user_ids, length=cnt)
             )
 
-    stmt = (
-        select(Comment)
-        .options(load_only(Comment.id, Comment.created_at, raiseload=True))
-        .order_by(Comment.id.asc())
+    stmt = select(Comment).options(
+        load_only(Comment.id, Comment.created_at, raiseload=True)
     )
-    offset = 0
     step = 1000
 
-    while True:
-        stmt = stmt.offset(offset).limit(step)
-        comments = session.scalars(stmt).all()
-
-        if not len(comments):
-            break
-
+    for comments in iter_batches(session, stmt, Comment.id, checkpoint, step):
         session.add_all(_generate_comment_likes(comments))
+        checkpoint.last_id = comments[-1].id
         session.commit()
-        print(f"CommentLike of {offset + len(comments)} comments created...")
-
-        offset += step
+        print(f"CommentLike of comments up to #{checkpoint.last_id} created...")
 
     print("CommentLike generation complete.")
 
 
-def build_and_seed():
-    drop_models()
+def build_and_seed(rebuild: bool = False, extra_months: int = 0):
+    """
+    Seed the database, resuming every stage from its checkpoint.
+    Pass `rebuild=True` to drop all tables (checkpoints included) first,
+    and `extra_months` to extend the posts past the last generated month.
+    """
+    if rebuild:
+        drop_models()
     migrate_models()
     generate_tags()
     generate_users(100)
-    generate_posts()
+    generate_posts(extra_months=extra_months)
     generate_post_tags()
     generate_post_likes()
     generate_post_comments()
@@ -20,73 +20,69 @@ from datetime import datetime
 
 
 def sql_query():
-    from sql_db.models import Tag, Post, PostLike, Comment
+    from sql_db.models import Tag, Post, PostLike, PostTag, Comment
     from sql_db.db_config import engine
-    from sqlalchemy import select, and_, func
+    from sql_db.id_filter import id_filter
+    from sqlalchemy import select, and_
     from sqlalchemy.orm import (
         selectinload,
         Session,
         load_only,
         with_loader_criteria,
-        joinedload,
     )
+    from author_resolver import sql_author_resolver
 
-    session = Session(engine)
-
-    # Step 1. collect tags and there related posts
-    stmt = (
-        select(Tag)
-        .order_by(Tag.name.asc())
-        .options(
-            load_only(Tag.id, Tag.name),
-            selectinload(Tag.posts).options(
-                load_only(Post.id, Post.title, Post.views, raiseload=True),
-                joinedload(Post.user),
-            ),
-            with_loader_criteria(
-                Post,
-                and_(
-                    Post.created_at >= datetime(2025, 6, 1),
-                    Post.created_at <= datetime(2025, 6, 30),
+    published_in_june = and_(
+        Post.created_at >= datetime(2025, 6, 1),
+        Post.created_at <= datetime(2025, 6, 30),
+    )
+
+    with Session(engine) as session:
+        # Step 1. collect tags and there related posts
+        stmt = (
+            select(Tag)
+            .order_by(Tag.name.asc())
+            .options(
+                load_only(Tag.id, Tag.name),
+                selectinload(Tag.posts).options(
+                    load_only(
+                        Post.id, Post.title, Post.views, Post.user_id, raiseload=True
+                    ),
                 ),
-            ),
+                with_loader_criteria(Post, published_in_june),
+            )
         )
-    )
-    tags = session.scalars(stmt).all()
+        tags = session.scalars(stmt).all()
 
-    post_ids = set(post.id for tag in tags for post in tag.posts)
+        post_ids = set(post.id for tag in tags for post in tag.posts)
 
-    # Step 2. collect Post likes count
-    stmt = (
-        select(PostLike.post_id, func.count(PostLike.id))
-        .select_from(PostLike)
-        .where(PostLike.post_id.in_(post_ids))
-        .group_by(PostLike.post_id)
-    )
-    results = session.execute(stmt).all()
-    post_like_cnt = {result[0]: result[1] for result in results}
-
-    # Step 3. collect Post comment count
-    stmt = (
-        select(Comment.post_id, func.count(Comment.id))
-        .select_from(Comment)
-        .where(Comment.post_id.in_(post_ids))
-        .group_by(Comment.post_id)
-    )
-    results = session.execute(stmt).all()
-    post_cmt_cnt = {result[0]: result[1] for result in results}
+        # The same posts as Step 1, for filters that push the predicate down
+        post_ids_stmt = (
+            select(PostTag.post_id)
+            .join(Post, Post.id == PostTag.post_id)
+            .where(published_in_june)
+        )
+
+        with id_filter(session, post_ids, source=post_ids_stmt) as flt:
+            # Step 2. collect Post likes count
+            post_like_cnt = flt.count_by(PostLike.post_id, PostLike.id)
+
+            # Step 3. collect Post comment count
+            post_cmt_cnt = flt.count_by(Comment.post_id, Comment.id)
+
+        # Step 4. resolve authors of the returned posts, in one batch
+        authors = sql_author_resolver.resolve(
+            post.user_id for tag in tags for post in tag.posts
+        )
 
-    # Step 4. organize data and return
+    # Step 5. organize data and return
     def _collect_tag_data(tag: Tag):
         posts = [
             {
                 "id": post.id,
                 "title": post.title,
                 "views": post.views,
-                "author": {
-                    "id": post.user.id,
-                    "name": post.user.name,
-                },
+                "author": authors[post.user_id],
                 "like_count": post_like_cnt.get(post.id, 0),
                 "comment_count": post_cmt_cnt.get(post.id, 0),
             }
@@ -106,6 +102,7 @@ def sql_query():
 def mongo_query():
     import mongo_db  # noqa: F401
     from mongo_db.models import Post
+    from author_resolver import mongo_author_resolver
 
     def _stages():
         # fmt: off
@@ -125,22 +122,6 @@ def mongo_query():
             "like_count": {"$size": "$likes"},
             "comment_count": {"$size": "$comments"},
         }}
-        yield {"$lookup": {
-            "from": "users",
-            "localField": "user",
-            "foreignField": "_id",
-            "as": "user",
-        }}
-        yield {"$addFields": {
-            "user": {"$first": "$user"},
-        }}
-        yield {"$addFields": {
-            "author": {
-                "id": "$user.sql_id",
-                "name": "$user.name",
-            },
-        }}
-        yield {"$unset": "user"}
         yield {"$unwind": "$tags"}
         yield {"$group": {
             "_id": "$tags",
@@ -179,26 +160,38 @@ def mongo_query():
         yield {"$sort": {"_id": 1}}
         # fmt: on
 
+    docs = list(Post.objects.aggregate(_stages()))
+
+    # Authors are resolved once for all the returned posts, instead of a $lookup per post
+    authors = mongo_author_resolver.resolve(
+        post["user"] for doc in docs for post in doc["posts"]
+    )
+
+    def _with_author(post: dict):
+        post["author"] = authors[post.pop("user")]
+        return post
+
     return {
         doc["_id"]: {
-            "posts": doc["posts"],
-            "best_view": doc["best_view"],
-            "best_like": doc["best_like"],
-            "best_comment": doc["best_comment"],
+            "posts": [_with_author(post) for post in doc["posts"]],
+            "best_view": _with_author(doc["best_view"]),
+            "best_like": _with_author(doc["best_like"]),
+            "best_comment": _with_author(doc["best_comment"]),
         }
-        for doc in Post.objects.aggregate(_stages())
+        for doc in docs
     }
 
 
-sql_results = sql_query()
-mongo_results = mongo_query()
+if __name__ == "__main__":
+    sql_results = sql_query()
+    mongo_results = mongo_query()
 
-for (sql_tag, sql_data), (mongo_tag, mongo_data) in zip(
-    sql_results.items(), mongo_results.items()
-):
-    assert sql_tag == mongo_tag
-    assert sql_data["best_view"] == mongo_data["best_view"]
-    assert sql_data["best_like"] == mongo_data["best_like"]
-    assert sql_data["best_comment"] == mongo_data["best_comment"]
+    for (sql_tag, sql_data), (mongo_tag, mongo_data) in zip(
+        sql_results.items(), mongo_results.items()
+    ):
+        assert sql_tag == mongo_tag
+        assert sql_data["best_view"] == mongo_data["best_view"]
+        assert sql_data["best_like"] == mongo_data["best_like"]
+        assert sql_data["best_comment"] == mongo_data["best_comment"]
 
-print("Query comparison done.")
+    print("Query comparison done.")
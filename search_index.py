@@ -0,0 +1,881 @@
+"""
+Full-text search over post titles, bodies and comments, CJK aware.
+
+The seed data is zh_tw, which neither `LIKE '%...%'` nor Mongo's default text
+index can search efficiently. Text is split into runs of CJK characters, which
+are indexed as overlapping bigrams and as single characters, and runs of latin
+letters / digits, indexed as words. Postings keep term positions, so a
+multi-character query only matches where its bigrams are adjacent, and results
+are ranked with BM25. Postings are split in blocks that record an upper bound of
+their scores, so a top-k search skips the blocks that cannot make it.
+
+    index = SearchIndex("search.idx")
+    update_from_sql(index)  # or update_from_mongo(index), new posts and posts with new comments
+    index.search("台北美食", limit=10)
+    index.search("台北", tag_index=tags, all_of=["美食"], start=date(2025, 6, 1))
+
+The index is a directory of immutable, memory-mapped segment files and a
+manifest. Every `commit()` writes a new segment; a post indexed again (e.g.
+after new comments) supersedes its older copies, and `merge()` compacts all
+segments into one.
+"""
+
+import bisect
+import heapq
+import itertools
+import json
+import math
+import mmap
+import os
+import re
+import shutil
+import struct
+import sys
+import tempfile
+import unicodedata
+from array import array
+from collections.abc import Iterable, Iterator, Sequence
+from datetime import date, datetime
+
+from tag_index import Bitmap, TagIndex
+
+# fmt: off
+FIELD_WEIGHTS = {"title": 2.0, "body": 1.0, "comments": 0.5}
+# Position gap between fields and comments, so phrases never match across them
+FIELD_GAP     = 100
+BM25_K1       = 1.2
+BM25_B        = 0.75
+SEGMENT_SIZE  = 50_000
+# Postings per block, the unit top-k searches skip
+BLOCK_SIZE    = 128
+# fmt: on
+
+# Score bounds are computed from float32 tfs and lengths, keep them on the safe side
+_BOUND_SLACK = 1.000001
+
+MAGIC = b"PSRC"
+VERSION = 2
+
+_header = struct.Struct("<4sII")
+
+_CJK = (
+    "\u3040-\u30ff"  # kana
+    "\u3400-\u4dbf"  # CJK extension A
+    "\u4e00-\u9fff"  # CJK unified ideographs
+    "\uac00-\ud7af"  # hangul
+    "\uf900-\ufaff"  # CJK compatibility ideographs
+)
+_token_re = re.compile(rf"(?P<cjk>[{_CJK}]+)|(?P<word>[0-9a-z\u00c0-\u024f]+)")
+
+
+def _runs(text: str) -> Iterator[tuple[str, bool]]:
+    text = unicodedata.normalize("NFKC", text).lower()
+    for match in _token_re.finditer(text):
+        yield match.group(), match.lastgroup == "cjk"
+
+
+def analyze(text: str, start: int = 0) -> Iterator[tuple[str, int]]:
+    """
+    Yield `(term, position)` of `text`, positions counted from `start`. A CJK
+    character yields itself and the bigram it starts, at the same position.
+    """
+    pos = start
+    for run, is_cjk in _runs(text):
+        if not is_cjk:
+            yield run, pos
+            pos += 1
+            continue
+
+        for idx, char in enumerate(run):
+            yield char, pos + idx
+            if idx + 1 < len(run):
+                yield run[idx : idx + 2], pos + idx
+        pos += len(run)
+
+
+class Phrase:
+    """Terms that must appear at consecutive positions."""
+
+    __slots__ = ("terms",)
+
+    def __init__(self, terms: Sequence[str]):
+        self.terms = terms
+
+    def __repr__(self) -> str:
+        return f"Phrase({self.terms!r})"
+
+
+def parse_query(text: str) -> list[Phrase]:
+    phrases = []
+    for run, is_cjk in _runs(text):
+        if not is_cjk or len(run) == 1:
+            phrases.append(Phrase([run]))
+        else:
+            phrases.append(Phrase([run[i : i + 2] for i in range(len(run) - 1)]))
+    return phrases
+
+
+class SegmentBuilder:
+    """Postings of the documents added since the last commit, kept in memory."""
+
+    def __init__(self):
+        self.doc_ids = array("I")
+        self._post_ids: set[int] = set()
+        self.doc_lens = array("f")
+        # term -> (local doc numbers, weighted term frequencies, positions per doc)
+        self.postings: dict[str, tuple[array, array, list[array]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def __contains__(self, post_id: int) -> bool:
+        return post_id in self._post_ids
+
+    def add(self, post_id: int, title: str = "", body: str = "", comments: Iterable[str] = ()):
+        fields = [("title", title), ("body", body)]
+        fields += [("comments", comment) for comment in comments]
+
+        terms: dict[str, tuple[float, array]] = {}
+        doc_len, start = 0.0, 0
+        for field, text in fields:
+            weight = FIELD_WEIGHTS[field]
+            pos = last_pos = start - 1
+            for term, pos in analyze(text or "", start):
+                tf, positions = terms.get(term) or (0.0, array("I"))
+                positions.append(pos)
+                terms[term] = (tf + weight, positions)
+                # Length in positions, a character and its bigram count once
+                if pos != last_pos:
+                    doc_len += weight
+                    last_pos = pos
+            start = pos + 1 + FIELD_GAP
+
+        self._append(post_id, doc_len, terms)
+
+    def _append(self, post_id: int, doc_len: float, terms: dict[str, tuple[float, array]]):
+        local = len(self.doc_ids)
+        self.doc_ids.append(post_id)
+        self._post_ids.add(post_id)
+        self.doc_lens.append(doc_len)
+
+        for term, (tf, positions) in terms.items():
+            if (entry := self.postings.get(term)) is None:
+                entry = self.postings[term] = (array("I"), array("f"), [])
+            entry[0].append(local)
+            entry[1].append(tf)
+            entry[2].append(positions)
+
+    def write(self, path: str):
+        def _postings():
+            for term in sorted(self.postings):
+                docs, tfs, positions = self.postings[term]
+                pos_offsets = array("I", [0])
+                for doc_positions in positions:
+                    pos_offsets.append(pos_offsets[-1] + len(doc_positions))
+                yield term.encode(), _encode_postings(
+                    docs,
+                    tfs,
+                    pos_offsets,
+                    b"".join(p.tobytes() for p in positions),
+                    self.doc_lens,
+                )
+
+        _write_segment(path, self.doc_ids, self.doc_lens, _postings())
+
+
+def _encode_postings(
+    docs: array, tfs: array, pos_offsets: array, positions, doc_lens: Sequence[float]
+) -> bytes:
+    # Document length / tf of every posting, the lower the higher the score
+    ratios = array("f", (doc_lens[local] / tf for local, tf in zip(docs, tfs)))
+
+    # Per block: last doc, highest tf and lowest ratio, which bound its scores
+    block_last, block_max_tf, block_min_ratio = array("I"), array("f"), array("f")
+    for lo in range(0, len(docs), BLOCK_SIZE):
+        block_last.append(docs[min(lo + BLOCK_SIZE, len(docs)) - 1])
+        block_max_tf.append(max(tfs[lo : lo + BLOCK_SIZE]))
+        block_min_ratio.append(min(ratios[lo : lo + BLOCK_SIZE]))
+
+    return b"".join(
+        (
+            struct.pack("=II", len(docs), pos_offsets[-1]),
+            docs.tobytes(),
+            tfs.tobytes(),
+            ratios.tobytes(),
+            pos_offsets.tobytes(),
+            positions,
+            block_last.tobytes(),
+            block_max_tf.tobytes(),
+            block_min_ratio.tobytes(),
+        )
+    )
+
+
+def _write_segment(
+    path: str, doc_ids: array, doc_lens: array, postings: Iterable[tuple[bytes, bytes]]
+):
+    """
+    Write a segment from encoded `(term, postings)` in term order. Postings are
+    spooled to a temporary file as they come, only the term list stays in memory.
+    """
+    term_offsets, terms = array("I", [0]), []
+    post_offsets = array("Q", [0])
+
+    with tempfile.TemporaryFile(dir=os.path.dirname(path)) as spool:
+        for term, part in postings:
+            terms.append(term)
+            term_offsets.append(term_offsets[-1] + len(term))
+            spool.write(part)
+            post_offsets.append(post_offsets[-1] + len(part))
+
+        sections = {
+            "doc_ids": doc_ids.tobytes(),
+            "doc_lens": doc_lens.tobytes(),
+            "post_offsets": post_offsets.tobytes(),
+            "term_offsets": term_offsets.tobytes(),
+            "terms": b"".join(terms),
+        }
+        sizes = {name: len(data) for name, data in sections.items()}
+        # Last section, copied from the spool
+        sizes["postings"] = post_offsets[-1]
+
+        # Every section starts 8-byte aligned, relative to the end of the header
+        layout, offset = {}, 0
+        for name, size in sizes.items():
+            layout[name] = [offset, size]
+            offset += size + (-size % 8)
+
+        meta = json.dumps({"byteorder": sys.byteorder, "sections": layout}).encode()
+        meta += b" " * (-(_header.size + len(meta)) % 8)
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_header.pack(MAGIC, VERSION, len(meta)))
+            f.write(meta)
+            for data in sections.values():
+                f.write(data)
+                f.write(b"\0" * (-len(data) % 8))
+            spool.seek(0)
+            shutil.copyfileobj(spool, f)
+        os.replace(tmp_path, path)
+
+
+class _Terms:
+    """Sorted term list of a segment, bisectable without decoding."""
+
+    def __init__(self, offsets: memoryview, blob: memoryview):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> bytes:
+        return bytes(self.blob[self.offsets[idx] : self.offsets[idx + 1]])
+
+
+class Postings:
+    __slots__ = (
+        "docs",
+        "tfs",
+        "ratios",
+        "pos_offsets",
+        "positions",
+        "block_last",
+        "block_max_tf",
+        "block_min_ratio",
+    )
+
+    def __init__(
+        self,
+        docs,
+        tfs,
+        ratios,
+        pos_offsets,
+        positions,
+        block_last,
+        block_max_tf,
+        block_min_ratio,
+    ):
+        self.docs = docs
+        self.tfs = tfs
+        self.ratios = ratios
+        self.pos_offsets = pos_offsets
+        self.positions = positions
+        self.block_last = block_last
+        self.block_max_tf = block_max_tf
+        self.block_min_ratio = block_min_ratio
+
+    def positions_at(self, idx: int):
+        return self.positions[self.pos_offsets[idx] : self.pos_offsets[idx + 1]]
+
+
+class Segment:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, meta_len = _header.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a search segment (version {VERSION}).")
+
+        meta = json.loads(self._mmap[_header.size : _header.size + meta_len])
+        if meta["byteorder"] != sys.byteorder:
+            self._mmap.close()
+            raise ValueError(f"{path} was written on a {meta['byteorder']}-endian host.")
+
+        base = _header.size + meta_len
+        view = memoryview(self._mmap)
+
+        def _section(name: str, fmt: str = None) -> memoryview:
+            offset, length = meta["sections"][name]
+            section = view[base + offset : base + offset + length]
+            return section.cast(fmt) if fmt else section
+
+        self.doc_ids = _section("doc_ids", "I")
+        self.doc_lens = _section("doc_lens", "f")
+        self.terms = _Terms(_section("term_offsets", "I"), _section("terms"))
+        self._post_offsets = _section("post_offsets", "Q")
+        self._postings = _section("postings")
+
+        self.doc_set = Bitmap(self.doc_ids)
+        self.total_len = sum(self.doc_lens)
+        self._local_of: array | None = None
+        self.supersede(Bitmap())
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def supersede(self, newer: Bitmap):
+        """Hide the documents of the posts in `newer`, indexed again in a newer segment."""
+        self.superseded = newer
+        # Local doc numbers of the hidden documents, and what is left for BM25 statistics
+        self.dead = Bitmap()
+        if self.doc_set & newer:
+            self.dead.update(
+                local for local, post_id in enumerate(self.doc_ids) if post_id in newer
+            )
+        self.live_count = len(self) - len(self.dead)
+        self.live_len = self.total_len - sum(self.doc_lens[local] for local in self.dead)
+
+    def live_docs_of(self, post_ids: Bitmap) -> array:
+        """Local doc numbers of the live documents of `post_ids`, in order."""
+        if self._local_of is None:
+            # Local doc number of every post id from the lowest one, -1 for the posts not here
+            self._first_id = min(self.doc_ids, default=0)
+            self._local_of = array("i", [-1]) * (max(self.doc_ids, default=-1) + 1 - self._first_id)
+            for local, post_id in enumerate(self.doc_ids):
+                self._local_of[post_id - self._first_id] = local
+
+        live = (post_ids & self.doc_set) - self.superseded
+        return array("I", sorted(self._local_of[post_id - self._first_id] for post_id in live))
+
+    def doc_freq(self, postings: Postings) -> int:
+        """Live documents of `postings`."""
+        if not self.dead:
+            return len(postings.docs)
+        return sum(1 for local in postings.docs if local not in self.dead)
+
+    def lookup(self, term: str) -> Postings | None:
+        """Postings of `term`, None if it is not in this segment."""
+        key = term.encode()
+        idx = bisect.bisect_left(self.terms, key)
+        if idx < len(self.terms) and self.terms[idx] == key:
+            return self.postings(idx)
+        return None
+
+    def postings(self, term_idx: int) -> Postings:
+        start = self._post_offsets[term_idx]
+        df, npos = struct.unpack_from("=II", self._postings, start)
+
+        def _array(fmt: str, length: int):
+            nonlocal start
+            section = self._postings[start : start + 4 * length].cast(fmt)
+            start += 4 * length
+            return section
+
+        start += 8
+        blocks = -(-df // BLOCK_SIZE)
+        return Postings(
+            _array("I", df),
+            _array("f", df),
+            _array("f", df),
+            _array("I", df + 1),
+            _array("I", npos),
+            _array("I", blocks),
+            _array("f", blocks),
+            _array("f", blocks),
+        )
+
+    def close(self):
+        for section in (
+            self.doc_ids,
+            self.doc_lens,
+            self.terms.offsets,
+            self.terms.blob,
+            self._post_offsets,
+            self._postings,
+        ):
+            section.release()
+        self._mmap.close()
+
+
+class SearchIndex:
+    def __init__(self, path: str | os.PathLike, segment_size: int = SEGMENT_SIZE):
+        self.path = os.fspath(path)
+        self.segment_size = segment_size
+        os.makedirs(self.path, exist_ok=True)
+
+        # `last_comment_id` / `last_comment_at`: newest comment seen by update_from_sql() / _mongo()
+        self.manifest = {"segments": [], "next_segment": 1, "last_post_id": 0}
+        if os.path.exists(manifest_path := os.path.join(self.path, "manifest.json")):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+
+        self.segments = [
+            Segment(os.path.join(self.path, name)) for name in self.manifest["segments"]
+        ]
+        self._mark_superseded()
+        self.pending = SegmentBuilder()
+
+    @property
+    def last_post_id(self) -> int:
+        """Highest post id committed to the index, where incremental updates resume."""
+        return self.manifest["last_post_id"]
+
+    def __len__(self) -> int:
+        return sum(s.live_count for s in self.segments)
+
+    def _mark_superseded(self):
+        newer = Bitmap()
+        for segment in reversed(self.segments):
+            segment.supersede(newer)
+            newer = newer | segment.doc_set
+
+    def _write_manifest(self):
+        manifest_path = os.path.join(self.path, "manifest.json")
+        with open(f"{manifest_path}.tmp", "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(f"{manifest_path}.tmp", manifest_path)
+
+    def add(self, post_id: int, title: str = "", body: str = "", comments: Iterable[str] = ()):
+        """Index a post, or index it again. It becomes searchable on the next `commit()`."""
+        # A segment holds one copy per post, the newer one has to go to a newer segment
+        if post_id in self.pending:
+            self.commit()
+        self.pending.add(post_id, title, body, comments)
+        if len(self.pending) >= self.segment_size:
+            self.commit()
+
+    def commit(self, **progress):
+        """Write the pending posts to a new segment, and `progress` to the manifest with it."""
+        if not len(self.pending):
+            if progress:
+                self.manifest.update(progress)
+                self._write_manifest()
+            return
+
+        name = f"seg-{self.manifest['next_segment']:06d}.seg"
+        self.pending.write(os.path.join(self.path, name))
+
+        self.manifest["segments"].append(name)
+        self.manifest["next_segment"] += 1
+        self.manifest["last_post_id"] = max(
+            self.manifest["last_post_id"], max(self.pending.doc_ids)
+        )
+        self.manifest.update(progress)
+        self._write_manifest()
+
+        self.segments.append(Segment(os.path.join(self.path, name)))
+        self._mark_superseded()
+        self.pending = SegmentBuilder()
+
+    def merge(self):
+        """
+        Compact every segment into one, dropping superseded documents. Postings
+        are merged term by term, streamed from the segments to the new file.
+        """
+        self.commit()
+        if len(self.segments) < 2:
+            return
+
+        # Live documents keep their order, segment after segment
+        doc_ids, doc_lens, remaps = array("I"), array("f"), []
+        for segment in self.segments:
+            if not segment.dead:
+                remaps.append(array("i", range(len(doc_ids), len(doc_ids) + len(segment))))
+                doc_ids.extend(segment.doc_ids)
+                doc_lens.extend(segment.doc_lens)
+                continue
+
+            remap = array("i", [-1]) * len(segment)
+            for local in range(len(segment)):
+                if local not in segment.dead:
+                    remap[local] = len(doc_ids)
+                    doc_ids.append(segment.doc_ids[local])
+                    doc_lens.append(segment.doc_lens[local])
+            remaps.append(remap)
+
+        name = f"seg-{self.manifest['next_segment']:06d}.seg"
+        _write_segment(
+            os.path.join(self.path, name),
+            doc_ids,
+            doc_lens,
+            _merge_postings(self.segments, remaps, doc_lens),
+        )
+
+        old_segments = self.segments
+        self.manifest["segments"] = [name]
+        self.manifest["next_segment"] += 1
+        self._write_manifest()
+
+        self.segments = [Segment(os.path.join(self.path, name))]
+        self._mark_superseded()
+
+        for segment in old_segments:
+            segment.close()
+            os.remove(segment.path)
+
+    def search(
+        self,
+        query: str,
+        limit: int = 10,
+        tag_index: TagIndex = None,
+        all_of: Iterable[str] = (),
+        any_of: Iterable[str] = (),
+        none_of: Iterable[str] = (),
+        start: date = None,
+        end: date = None,
+    ) -> list[tuple[int, float]]:
+        """
+        Top `limit` `(post id, score)` matching every phrase of `query`.
+        Tag and date filters are evaluated with `tag_index`, see `TagIndex.query()`.
+        """
+        allowed = None
+        if any((all_of, any_of, none_of, start, end)):
+            if tag_index is None:
+                raise ValueError("Tag and date filters need a tag_index.")
+            allowed = tag_index.query(all_of, any_of, none_of, start, end)
+
+        if not (phrases := parse_query(query)) or not self.segments or limit <= 0:
+            return []
+
+        # Superseded copies are left out, as if the segments had been merged
+        doc_count = len(self) or 1
+        avg_len = sum(s.live_len for s in self.segments) / doc_count or 1.0
+
+        # Resolve every query term in every segment, for document frequencies
+        terms = [term for phrase in phrases for term in phrase.terms]
+        resolved: list[list[Postings | None]] = []
+        dfs = [0] * len(terms)
+        for segment in self.segments:
+            per_term = [segment.lookup(term) for term in terms]
+            for idx, postings in enumerate(per_term):
+                if postings is not None:
+                    dfs[idx] += segment.doc_freq(postings)
+            resolved.append(per_term)
+
+        idfs = [math.log(1 + (doc_count - df + 0.5) / (df + 0.5)) for df in dfs]
+
+        # Min-heap of the best `(score, post id)` so far, shared by the segments
+        top: list[tuple[float, int]] = []
+        for segment, per_term in zip(self.segments, resolved):
+            if all(postings is not None for postings in per_term):
+                self._search_segment(
+                    segment, phrases, per_term, idfs, avg_len, allowed, top, limit
+                )
+
+        return [(post_id, score) for score, post_id in sorted(top, reverse=True)]
+
+    @staticmethod
+    def _search_segment(
+        segment: Segment,
+        phrases: list[Phrase],
+        slots: list[Postings],
+        idfs: list[float],
+        avg_len: float,
+        allowed: Bitmap | None,
+        top: list[tuple[float, int]],
+        limit: int,
+    ):
+        """
+        Push the matches of `segment` that make it into the top `limit` to `top`.
+
+        The rarest term drives the intersection, block by block. Once `top` is
+        full, a block is skipped when the sum of the score bounds of the blocks
+        it overlaps, over every term, is below the lowest score kept.
+        """
+        # Slot ranges of the phrases whose terms must be adjacent
+        spans, start = [], 0
+        for phrase in phrases:
+            if len(phrase.terms) > 1:
+                spans.append((start, len(phrase.terms)))
+            start += len(phrase.terms)
+
+        # BM25 of a term is idf * (k1 + 1) / (1 + (k1 * (1 - b) + k1 * b * length / avg) / tf),
+        # a block's highest tf and lowest length / tf bound it from above
+        norm_base = BM25_K1 * (1 - BM25_B)
+        norm_len = BM25_K1 * BM25_B / avg_len
+        bounds = [
+            [
+                idf * (BM25_K1 + 1) / (1 + norm_base / tf + norm_len * ratio) * _BOUND_SLACK
+                for tf, ratio in zip(p.block_max_tf, p.block_min_ratio)
+            ]
+            for idf, p in zip(idfs, slots)
+        ]
+
+        driver = min(range(len(slots)), key=lambda i: len(slots[i].docs))
+        dead = segment.dead or None
+        if allowed is not None and len(allowed) < len(slots[driver].docs):
+            # The filter is narrower than every term, it drives and scores nothing
+            driver = None
+            docs = segment.live_docs_of(allowed)
+            driver_bounds = [0.0] * -(-len(docs) // BLOCK_SIZE)
+            allowed = dead = None
+        else:
+            driver_slot, idf = slots[driver], idfs[driver]
+            docs, tfs = driver_slot.docs, driver_slot.tfs
+            driver_bounds = bounds[driver]
+
+        others = [i for i in range(len(slots)) if i != driver]
+        doc_lens, doc_ids = segment.doc_lens, segment.doc_ids
+        # Probing positions in the other slots, driver docs only go up
+        hints = [0] * len(slots)
+
+        for block, driver_bound in enumerate(driver_bounds):
+            lo = block * BLOCK_SIZE
+            hi = min(lo + BLOCK_SIZE, len(docs))
+
+            # Bound of what the other slots can add to a document of this block
+            others_bound = 0.0
+            for i in others:
+                block_last = slots[i].block_last
+                first = bisect.bisect_left(block_last, docs[lo])
+                if first == len(block_last):
+                    # This term has no document past here, neither will any match
+                    return
+                last = bisect.bisect_left(block_last, docs[hi - 1], first)
+                others_bound += max(bounds[i][first : last + 1])
+
+            full = len(top) >= limit
+            candidates = range(lo, hi)
+            if full:
+                if driver_bound + others_bound < top[0][0]:
+                    continue
+
+                # The driver term has to score `needed`, which caps the ratio of its postings
+                needed = 0.0
+                if driver is not None:
+                    needed = (top[0][0] - others_bound) / (idf * (BM25_K1 + 1))
+                if needed > 0:
+                    max_ratio = (
+                        1 / needed - 1 - norm_base / driver_slot.block_max_tf[block]
+                    ) / norm_len
+                    max_ratio += abs(max_ratio) * (_BOUND_SLACK - 1)
+                    candidates = itertools.compress(
+                        candidates, map(max_ratio.__ge__, driver_slot.ratios[lo:hi])
+                    )
+
+            for idx in candidates:
+                local = docs[idx]
+                if dead is not None and local in dead:
+                    continue
+
+                norm = norm_base + norm_len * doc_lens[local]
+                score = 0.0
+                if driver is not None:
+                    tf = tfs[idx]
+                    score = idf * tf * (BM25_K1 + 1) / (tf + norm)
+                if full and score + others_bound < top[0][0]:
+                    continue
+
+                post_id = doc_ids[local]
+                if allowed is not None and post_id not in allowed:
+                    continue
+
+                # Postings index of every slot in this document
+                hits = hints.copy()
+                if driver is not None:
+                    hits[driver] = idx
+                for i in others:
+                    slot_docs = slots[i].docs
+                    j = hints[i] = bisect.bisect_left(slot_docs, local, hints[i])
+                    if j == len(slot_docs) or slot_docs[j] != local:
+                        break
+                    hits[i] = j
+                    tf = slots[i].tfs[j]
+                    score += idfs[i] * tf * (BM25_K1 + 1) / (tf + norm)
+                else:
+                    entry = (score, post_id)
+                    if full and entry <= top[0]:
+                        continue
+                    if spans and not _phrases_match(slots, hits, spans):
+                        continue
+
+                    if full:
+                        heapq.heapreplace(top, entry)
+                    else:
+                        heapq.heappush(top, entry)
+                        full = len(top) >= limit
+
+
+def _merge_postings(
+    segments: list[Segment], remaps: list[array], doc_lens: array
+) -> Iterator[tuple[bytes, bytes]]:
+    """
+    Encoded `(term, postings)` of `segments` in term order, local doc numbers
+    mapped through `remaps` and documents mapped to -1 left out.
+    """
+    def _stream(n: int, segment: Segment) -> Iterator[tuple[bytes, int, int]]:
+        for idx in range(len(segment.terms)):
+            yield segment.terms[idx], n, idx
+
+    streams = [_stream(n, segment) for n, segment in enumerate(segments)]
+    for term, entries in itertools.groupby(heapq.merge(*streams), key=lambda e: e[0]):
+        docs, tfs, pos_offsets, positions = array("I"), array("f"), array("I", [0]), array("I")
+
+        for _, n, term_idx in entries:
+            postings, remap = segments[n].postings(term_idx), remaps[n]
+            for idx, local in enumerate(postings.docs):
+                if (new_local := remap[local]) < 0:
+                    continue
+                docs.append(new_local)
+                tfs.append(postings.tfs[idx])
+                positions.frombytes(postings.positions_at(idx).tobytes())
+                pos_offsets.append(len(positions))
+
+        if docs:
+            yield term, _encode_postings(docs, tfs, pos_offsets, positions.tobytes(), doc_lens)
+
+
+def _phrases_match(
+    slots: list[Postings], hits: list[int], spans: list[tuple[int, int]]
+) -> bool:
+    """Whether the terms of every phrase appear at consecutive positions."""
+    for start, size in spans:
+        first, *rest = (
+            slots[i].positions_at(hits[i]) for i in range(start, start + size)
+        )
+        rest = [set(positions) for positions in rest]
+        if not any(all(pos + k in r for k, r in enumerate(rest, 1)) for pos in first):
+            return False
+    return True
+
+
+def update_from_sql(index: SearchIndex, step: int = 1000) -> SearchIndex:
+    """
+    Index the MySQL posts created since the last update, and index again the
+    posts commented since then. Segments are committed every `index.segment_size`
+    posts, an interrupted update resumes from the last one.
+    """
+    from sqlalchemy import func, select
+    from sqlalchemy.orm import Session, load_only, selectinload
+    from sql_db.db_config import engine
+    from sql_db.models import Post, Comment
+
+    base_stmt = (
+        select(Post)
+        .options(
+            load_only(Post.id, Post.title, Post.body, raiseload=True),
+            selectinload(Post.comments).options(load_only(Comment.body, raiseload=True)),
+        )
+        .order_by(Post.id.asc())
+    )
+
+    last_id = index.last_post_id
+    last_comment_id = index.manifest.get("last_comment_id", 0)
+
+    with Session(engine) as session:
+        max_comment_id = session.scalar(select(func.max(Comment.id))) or 0
+
+        # Posts already indexed whose comments changed, the new copy supersedes the old one
+        changed_stmt = (
+            select(Comment.post_id)
+            .distinct()
+            .where(
+                Comment.id > last_comment_id,
+                Comment.id <= max_comment_id,
+                Comment.post_id <= last_id,
+            )
+            .order_by(Comment.post_id.asc())
+        )
+        changed_id = 0
+        while True:
+            stmt = changed_stmt.where(Comment.post_id > changed_id).limit(step)
+
+            if not (post_ids := session.scalars(stmt).all()):
+                break
+
+            for p in session.scalars(base_stmt.where(Post.id.in_(post_ids))):
+                index.add(p.id, p.title, p.body, (c.body for c in p.comments))
+            changed_id = post_ids[-1]
+
+            print(f"Commented posts up to #{changed_id} indexed again...")
+
+        while True:
+            stmt = base_stmt.where(Post.id > last_id).limit(step)
+
+            if not (posts := session.scalars(stmt).all()):
+                break
+
+            for p in posts:
+                index.add(p.id, p.title, p.body, (c.body for c in p.comments))
+            last_id = posts[-1].id
+
+            print(f"Posts up to #{last_id} indexed...")
+
+    index.commit(last_comment_id=max_comment_id)
+    return index
+
+
+def update_from_mongo(index: SearchIndex, step: int = 1000) -> SearchIndex:
+    """
+    Index the Mongo posts created since the last update, and index again the
+    posts commented since then, keyed by `sql_id`.
+    """
+    import mongo_db  # noqa: F401
+    from mongo_db.models import Post
+
+    collection = Post._get_collection()
+    projection = {"_id": False, "sql_id": True, "title": True, "body": True, "comments.body": True}
+
+    def _index_posts(message: str, last_id: int, max_id: int = None, **filters):
+        while True:
+            id_range = {"$gt": last_id} if max_id is None else {"$gt": last_id, "$lte": max_id}
+            posts = list(
+                collection.find({"sql_id": id_range, **filters}, projection)
+                .sort("sql_id", 1)
+                .limit(step)
+            )
+
+            if not posts:
+                break
+
+            for p in posts:
+                comments = (c["body"] for c in p.get("comments", ()))
+                index.add(p["sql_id"], p.get("title", ""), p.get("body", ""), comments)
+            last_id = posts[-1]["sql_id"]
+
+            print(f"{message} up to #{last_id} indexed...")
+
+    last_id = index.last_post_id
+    last_comment_at = index.manifest.get("last_comment_at")
+    since = datetime.fromisoformat(last_comment_at) if last_comment_at else datetime.min
+
+    # Newest comment, found through the multikey index on comments.created_at
+    latest = collection.find_one(
+        {"comments.created_at": {"$exists": True}},
+        {"_id": False, "comments.created_at": True},
+        sort=[("comments.created_at", -1)],
+    )
+    until = max(c["created_at"] for c in latest["comments"]) if latest else since
+
+    # Posts already indexed whose comments changed, the new copy supersedes the old one
+    changed = {"$elemMatch": {"created_at": {"$gt": since, "$lte": until}}}
+    _index_posts("Commented posts", 0, last_id, comments=changed)
+    _index_posts("Posts", last_id)
+
+    index.commit(last_comment_at=until.isoformat())
+    return index
@@ -0,0 +1,176 @@
+"""
+Filter aggregates by a large set of ids without inlining every id in the statement.
+
+    with id_filter(session, post_ids, source=june_post_ids) as flt:
+        like_cnt = flt.count_by(PostLike.post_id, PostLike.id)
+        comment_cnt = flt.count_by(Comment.post_id, Comment.id)
+
+Every strategy supports `count_by()`. All but the chunked one are
+`StatementFilter`s, which can also restrict any statement with `apply()`.
+Strategies, picked by `id_filter()` from the size of the set:
+
+- `InListFilter`: a plain `IN (...)`, fine for small sets.
+- `SubqueryFilter`: `IN (<source>)`, pushing down the predicate the ids came
+  from, so the statement size does not depend on the number of ids at all.
+- `ChunkedInFilter`: `IN (...)` lists of bounded size, run in parallel.
+- `TempTableFilter`: ids bulk-loaded once into a session temporary table and joined.
+"""
+
+import itertools
+from abc import ABC, abstractmethod
+from collections.abc import Collection, Sequence
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import Column, MetaData, Select, Table, func, insert, select, text
+from sqlalchemy.dialects.mysql import INTEGER
+from sqlalchemy.orm import InstrumentedAttribute, Session
+
+# fmt: off
+IN_LIST_MAX     = 1_000
+CHUNKED_MAX     = 20_000
+CHUNK_SIZE      = 1_000
+CHUNK_WORKERS   = 4
+TEMP_LOAD_BATCH = 10_000
+# fmt: on
+
+
+class IdFilter(ABC):
+    def __init__(self, session: Session, ids: Collection[int]):
+        self.session = session
+        self.ids = ids
+
+    @abstractmethod
+    def count_by(
+        self, key: InstrumentedAttribute, counted: InstrumentedAttribute
+    ) -> dict[int, int]:
+        """`{key: count(counted)}` for rows whose `key` is in the id set."""
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class StatementFilter(IdFilter):
+    """Filter that fits in a single statement."""
+
+    @abstractmethod
+    def apply(self, stmt: Select, column: InstrumentedAttribute) -> Select:
+        """Restrict `stmt` to rows whose `column` is in the id set."""
+
+    def count_by(
+        self, key: InstrumentedAttribute, counted: InstrumentedAttribute
+    ) -> dict[int, int]:
+        stmt = select(key, func.count(counted)).group_by(key)
+        return dict(self.session.execute(self.apply(stmt, key)).all())
+
+
+class InListFilter(StatementFilter):
+    def apply(self, stmt: Select, column: InstrumentedAttribute) -> Select:
+        return stmt.where(column.in_(self.ids))
+
+
+class SubqueryFilter(StatementFilter):
+    def __init__(self, session: Session, ids: Collection[int], source: Select):
+        super().__init__(session, ids)
+        self.source = source
+
+    def apply(self, stmt: Select, column: InstrumentedAttribute) -> Select:
+        return stmt.where(column.in_(self.source))
+
+
+class ChunkedInFilter(IdFilter):
+    """
+    Not a `StatementFilter`: every chunk is counted on its own connection,
+    which works because the chunks split the groups as well.
+    """
+
+    def count_by(
+        self, key: InstrumentedAttribute, counted: InstrumentedAttribute
+    ) -> dict[int, int]:
+        stmt = select(key, func.count(counted)).group_by(key)
+        ids: Sequence[int] = sorted(self.ids)
+        chunks = (ids[i : i + CHUNK_SIZE] for i in range(0, len(ids), CHUNK_SIZE))
+
+        def _count(chunk: Sequence[int]):
+            with Session(self.session.get_bind()) as session:
+                return session.execute(stmt.where(key.in_(chunk))).all()
+
+        with ThreadPoolExecutor(max_workers=CHUNK_WORKERS) as executor:
+            return {k: cnt for rows in executor.map(_count, chunks) for k, cnt in rows}
+
+
+class TempTableFilter(StatementFilter):
+    _seq = itertools.count()
+
+    def __init__(self, session: Session, ids: Collection[int]):
+        super().__init__(session, ids)
+
+        self.table = Table(
+            f"tmp_filter_ids_{next(self._seq)}",
+            MetaData(),
+            Column("id", INTEGER(unsigned=True), primary_key=True),
+            prefixes=["TEMPORARY"],
+        )
+
+        # Temporary tables live on the connection, which the session keeps
+        # until the end of its transaction
+        conn = session.connection()
+        self.table.create(conn)
+
+        ids = list(ids)
+        for idx in range(0, len(ids), TEMP_LOAD_BATCH):
+            batch = ids[idx : idx + TEMP_LOAD_BATCH]
+            conn.execute(insert(self.table), [{"id": i} for i in batch])
+
+    def apply(self, stmt: Select, column: InstrumentedAttribute) -> Select:
+        return stmt.join(self.table, self.table.c.id == column)
+
+    def close(self):
+        conn = self.session.connection()
+        if conn.dialect.name == "mysql":
+            # A plain DROP TABLE implicitly commits the caller's transaction
+            name = conn.dialect.identifier_preparer.format_table(self.table)
+            conn.execute(text(f"DROP TEMPORARY TABLE {name}"))
+        else:
+            self.table.drop(conn)
+
+
+STRATEGIES = {
+    "in_list": InListFilter,
+    "subquery": SubqueryFilter,
+    "chunked": ChunkedInFilter,
+    "temp_table": TempTableFilter,
+}
+
+
+def id_filter(
+    session: Session,
+    ids: Collection[int],
+    source: Select = None,
+    strategy: str = None,
+) -> IdFilter:
+    """
+    Build a filter on `ids`. `source`, if given, is a statement selecting the
+    same ids (the predicate they came from) and enables the subquery strategy.
+    """
+    if strategy is None:
+        if len(ids) <= IN_LIST_MAX:
+            strategy = "in_list"
+        elif source is not None:
+            strategy = "subquery"
+        elif len(ids) <= CHUNKED_MAX:
+            strategy = "chunked"
+        else:
+            strategy = "temp_table"
+
+    if strategy == "subquery":
+        if source is None:
+            raise ValueError("The subquery strategy needs a source statement.")
+        return SubqueryFilter(session, ids, source)
+
+    return STRATEGIES[strategy](session, ids)
@@ -101,3 +101,23 @@ class PostTag(Base):
 
     post_id: Mapped[int] = mapped_column(ForeignKey("posts.id"), nullable=False)
     tag_id: Mapped[int] = mapped_column(ForeignKey("tags.id"), nullable=False)
+
+
+class SeedCheckpoint(Base):
+    """Progress of one seeding stage, committed together with each batch."""
+
+    __tablename__ = "seed_checkpoints"
+
+    stage: Mapped[str] = mapped_column(String(50), nullable=False, unique=True)
+    last_id: Mapped[int] = mapped_column(
+        INTEGER(unsigned=True), default=0, comment="last processed id of the stage"
+    )
+    watermark: Mapped[datetime | None] = mapped_column(
+        TIMESTAMP, nullable=True, comment="UTC timezone, end of last generated window"
+    )
+    updated_at: Mapped[datetime] = mapped_column(
+        TIMESTAMP,
+        server_default=func.now(),
+        onupdate=func.now(),
+        comment="UTC timezone",
+    )
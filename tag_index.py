@@ -0,0 +1,480 @@
+"""
+In-memory inverted index over post tags, for multi-tag queries such as
+"posts tagged A and B but not C, published in June".
+
+Every tag maps to a compressed `Bitmap` of post ids, and every month to the
+ids and publication days of its posts. The seeders insert posts in `created_at`
+order, so a month is usually a contiguous id range: months fully inside a date
+filter cost a range, only the boundary months are checked day by day.
+Queries are plain set algebra:
+
+    index = build_sql_index()
+    post_ids = index.query(all_of=["科技", "商業"], none_of=["八卦"], start=date(2025, 6, 1))
+
+    index.save("tags.idx")
+    index = TagIndex.load("tags.idx")  # memory-mapped, bitmaps decoded on first use
+"""
+
+import itertools
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections.abc import Iterable, Iterator
+from datetime import date, datetime
+
+# Bitmaps are split in containers of 2 ** 16 ids, keyed by the high bits
+CHUNK_BITS = 16
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+CHUNK_BYTES = (1 << CHUNK_BITS) // 8
+# Containers holding fewer ids are stored as sorted uint16 arrays on disk
+ARRAY_MAX = 4096
+
+ARRAY_CONTAINER = 0
+BITSET_CONTAINER = 1
+
+MAGIC = b"PTAG"
+VERSION = 2
+
+_header = struct.Struct("<4sII")
+_container = struct.Struct("<HBI")
+
+
+def _le_array(typecode: str, data=b"") -> array:
+    """Array of little-endian `typecode` items, whatever the platform."""
+    arr = array(typecode)
+    arr.frombytes(data)
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr
+
+
+def _le_bytes(arr: array) -> bytes:
+    if sys.byteorder == "big":
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+# Bits of every byte value as 0 / 1 bytes, to expand a dense container into a byte per id
+_BYTE_BITS = [bytes((byte >> bit) & 1 for bit in range(8)) for byte in range(256)]
+
+
+def _bits_of(word: int, base: int) -> Iterator[int]:
+    while word:
+        low = word & -word
+        yield base + low.bit_length() - 1
+        word ^= low
+
+
+class Bitmap:
+    """
+    Set of non-negative ids, stored as one bitset per non-empty 2 ** 16 id
+    range. Empty ranges take no space, and set operations work on whole
+    containers at once.
+    """
+
+    __slots__ = ("_chunks",)
+
+    def __init__(self, ids: Iterable[int] = ()):
+        self._chunks: dict[int, int] = {}
+        self.update(ids)
+
+    @classmethod
+    def from_range(cls, start: int, stop: int) -> "Bitmap":
+        """Bitmap of the ids in `range(start, stop)`."""
+        bitmap = cls()
+        for key in range(start >> CHUNK_BITS, ((stop - 1) >> CHUNK_BITS) + 1):
+            lo = max(start - (key << CHUNK_BITS), 0)
+            hi = min(stop - (key << CHUNK_BITS), 1 << CHUNK_BITS)
+            if lo < hi:
+                bitmap._chunks[key] = ((1 << (hi - lo)) - 1) << lo
+        return bitmap
+
+    @classmethod
+    def _from_chunks(cls, chunks: dict[int, int]) -> "Bitmap":
+        bitmap = cls()
+        bitmap._chunks = {key: bits for key, bits in chunks.items() if bits}
+        return bitmap
+
+    def add(self, id_: int):
+        key = id_ >> CHUNK_BITS
+        self._chunks[key] = self._chunks.get(key, 0) | (1 << (id_ & CHUNK_MASK))
+
+    def update(self, ids: Iterable[int]):
+        # Set bits in a byte buffer per container, much cheaper than big int ops per id
+        buffers: dict[int, bytearray] = {}
+        for id_ in ids:
+            key, low = id_ >> CHUNK_BITS, id_ & CHUNK_MASK
+            if (buf := buffers.get(key)) is None:
+                buf = buffers[key] = bytearray(CHUNK_BYTES)
+            buf[low >> 3] |= 1 << (low & 7)
+
+        for key, buf in buffers.items():
+            self._chunks[key] = self._chunks.get(key, 0) | int.from_bytes(buf, "little")
+
+    def discard(self, id_: int):
+        key = id_ >> CHUNK_BITS
+        if key in self._chunks:
+            if not (bits := self._chunks[key] & ~(1 << (id_ & CHUNK_MASK))):
+                del self._chunks[key]
+            else:
+                self._chunks[key] = bits
+
+    def __contains__(self, id_: int) -> bool:
+        return bool(self._chunks.get(id_ >> CHUNK_BITS, 0) >> (id_ & CHUNK_MASK) & 1)
+
+    def __len__(self) -> int:
+        return sum(bits.bit_count() for bits in self._chunks.values())
+
+    def __bool__(self) -> bool:
+        return bool(self._chunks)
+
+    def __iter__(self) -> Iterator[int]:
+        for key in sorted(self._chunks):
+            bits, base = self._chunks[key], key << CHUNK_BITS
+            if bits.bit_count() > ARRAY_MAX:
+                mask = b"".join(map(_BYTE_BITS.__getitem__, bits.to_bytes(CHUNK_BYTES, "little")))
+                yield from itertools.compress(range(base, base + (1 << CHUNK_BITS)), mask)
+                continue
+
+            words = array("Q", bits.to_bytes(CHUNK_BYTES, sys.byteorder))
+            for idx, word in enumerate(words):
+                if word:
+                    yield from _bits_of(word, base + idx * 64)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Bitmap) and self._chunks == other._chunks
+
+    def __repr__(self) -> str:
+        return f"<Bitmap of {len(self)} ids>"
+
+    def __and__(self, other: "Bitmap") -> "Bitmap":
+        small, large = sorted((self._chunks, other._chunks), key=len)
+        return Bitmap._from_chunks(
+            {key: bits & large[key] for key, bits in small.items() if key in large}
+        )
+
+    def __or__(self, other: "Bitmap") -> "Bitmap":
+        chunks = dict(self._chunks)
+        for key, bits in other._chunks.items():
+            chunks[key] = chunks.get(key, 0) | bits
+        return Bitmap._from_chunks(chunks)
+
+    def __sub__(self, other: "Bitmap") -> "Bitmap":
+        return Bitmap._from_chunks(
+            {
+                key: bits & ~other._chunks.get(key, 0)
+                for key, bits in self._chunks.items()
+            }
+        )
+
+    def copy(self) -> "Bitmap":
+        return Bitmap._from_chunks(self._chunks)
+
+    def to_bytes(self) -> bytes:
+        parts = [struct.pack("<I", len(self._chunks))]
+        for key in sorted(self._chunks):
+            bits = self._chunks[key]
+            if bits.bit_count() <= ARRAY_MAX:
+                payload = _le_bytes(array("H", _bits_of(bits, 0)))
+                parts.append(_container.pack(key, ARRAY_CONTAINER, len(payload)))
+            else:
+                payload = bits.to_bytes(CHUNK_BYTES, "little")
+                parts.append(_container.pack(key, BITSET_CONTAINER, len(payload)))
+            parts.append(payload)
+        return b"".join(parts)
+
+    @classmethod
+    def from_buffer(cls, buf) -> "Bitmap":
+        chunks = {}
+        (count,), pos = struct.unpack_from("<I", buf, 0), 4
+        for _ in range(count):
+            key, kind, size = _container.unpack_from(buf, pos)
+            pos += _container.size
+            payload = buf[pos : pos + size]
+            pos += size
+
+            if kind == BITSET_CONTAINER:
+                chunks[key] = int.from_bytes(payload, "little")
+            else:
+                chunks[key] = cls(_le_array("H", payload))._chunks.get(0, 0)
+        return cls._from_chunks(chunks)
+
+
+def month_of(day: date) -> str:
+    return f"{day.year:04d}-{day.month:02d}"
+
+
+def day_of(value: date) -> int:
+    """Proleptic ordinal of the day of a date or datetime."""
+    return (value.date() if isinstance(value, datetime) else value).toordinal()
+
+
+class MonthPosts:
+    """Ids of the posts published in one month, with the ordinal day of each."""
+
+    __slots__ = ("ids", "days", "first_id", "last_id", "first_day", "last_day")
+
+    def __init__(self, ids: array = None, days: array = None):
+        self.ids = ids if ids is not None else array("I")
+        self.days = days if days is not None else array("I")
+        self.first_id = min(self.ids, default=0)
+        self.last_id = max(self.ids, default=-1)
+        self.first_day = min(self.days, default=0)
+        self.last_day = max(self.days, default=-1)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, post_id: int, day: int):
+        if not self.ids:
+            self.first_id = self.last_id = post_id
+            self.first_day = self.last_day = day
+        self.ids.append(post_id)
+        self.days.append(day)
+        self.first_id, self.last_id = min(self.first_id, post_id), max(self.last_id, post_id)
+        self.first_day, self.last_day = min(self.first_day, day), max(self.last_day, day)
+
+    def between(self, first_day: int, last_day: int) -> Bitmap:
+        """Posts of the month published from `first_day` to `last_day`, both included."""
+        if first_day <= self.first_day and self.last_day <= last_day:
+            if self.last_id - self.first_id + 1 == len(self.ids):
+                return Bitmap.from_range(self.first_id, self.last_id + 1)
+            return Bitmap(self.ids)
+
+        return Bitmap(
+            post_id
+            for post_id, day in zip(self.ids, self.days)
+            if first_day <= day <= last_day
+        )
+
+
+class TagIndex:
+    def __init__(self):
+        self.posts = Bitmap()
+        # tag name -> Bitmap, or (offset, length) in the memory-mapped file until first use
+        self._tags: dict[str, Bitmap | tuple[int, int]] = {}
+        self.months: dict[str, MonthPosts] = {}
+        # last post id / post_tag id indexed, for incremental updates from MySQL
+        self.last_post_id = 0
+        self.last_post_tag_id = 0
+
+        self._mmap: mmap.mmap | None = None
+
+    @property
+    def tag_names(self) -> list[str]:
+        return sorted(self._tags)
+
+    def tag(self, name: str) -> Bitmap:
+        bitmap = self._tags.get(name)
+        if isinstance(bitmap, tuple):
+            offset, length = bitmap
+            bitmap = self._tags[name] = Bitmap.from_buffer(
+                self._mmap[offset : offset + length]
+            )
+        return bitmap if bitmap is not None else Bitmap()
+
+    def add(self, post_id: int, tags: Iterable[str], created_at: date = None):
+        """Index `post_id` under `tags`; tags added later to the same post are merged in."""
+        if created_at is not None and post_id not in self.posts:
+            self.months.setdefault(month_of(created_at), MonthPosts()).add(
+                post_id, day_of(created_at)
+            )
+        self.posts.add(post_id)
+        self.add_tags(post_id, tags)
+
+    def add_tags(self, post_id: int, tags: Iterable[str]):
+        """Tag `post_id` without indexing the post itself, queries ignore it until `add()`."""
+        for name in tags:
+            bitmap = self.tag(name)
+            bitmap.add(post_id)
+            self._tags[name] = bitmap
+
+    def remove_tag(self, post_id: int, name: str):
+        if name in self._tags:
+            self.tag(name).discard(post_id)
+
+    def published_between(self, start: date = None, end: date = None) -> Bitmap:
+        """Posts published from `start` to `end`, both days included."""
+        first_month = month_of(start) if start else ""
+        last_month = month_of(end) if end else "9999-12"
+        first_day = day_of(start) if start else 0
+        last_day = day_of(end) if end else date.max.toordinal()
+
+        bitmap = Bitmap()
+        for month, posts in self.months.items():
+            if first_month <= month <= last_month:
+                bitmap = bitmap | posts.between(first_day, last_day)
+        return bitmap & self.posts
+
+    def query(
+        self,
+        all_of: Iterable[str] = (),
+        any_of: Iterable[str] = (),
+        none_of: Iterable[str] = (),
+        start: date = None,
+        end: date = None,
+    ) -> Bitmap:
+        """Posts tagged with every tag of `all_of`, at least one of `any_of` and none of `none_of`."""
+        result = self.posts.copy()
+        if start or end:
+            result = self.published_between(start, end)
+
+        # Most selective first, so the intermediate results shrink quickly
+        for bitmap in sorted(map(self.tag, all_of), key=len):
+            if not result:
+                break
+            result = result & bitmap
+
+        if any_of := list(any_of):
+            union = Bitmap()
+            for name in any_of:
+                union = union | self.tag(name)
+            result = result & union
+
+        for name in none_of:
+            result = result - self.tag(name)
+
+        return result
+
+    def save(self, path: str | os.PathLike):
+        """Write the index to `path` atomically."""
+        blobs, directory, offset = [], {}, 0
+        for name in self.tag_names:
+            blob = self.tag(name).to_bytes()
+            directory[name] = [offset, len(blob)]
+            blobs.append(blob)
+            offset += len(blob)
+        posts = self.posts.to_bytes()
+        blobs.append(posts)
+        posts_entry = [offset, len(posts)]
+        offset += len(posts)
+
+        months = {}
+        for month, month_posts in sorted(self.months.items()):
+            blob = _le_bytes(month_posts.ids) + _le_bytes(month_posts.days)
+            months[month] = [offset, len(month_posts)]
+            blobs.append(blob)
+            offset += len(blob)
+
+        meta = json.dumps(
+            {
+                "tags": directory,
+                "posts": posts_entry,
+                "months": months,
+                "last_post_id": self.last_post_id,
+                "last_post_tag_id": self.last_post_tag_id,
+            },
+            ensure_ascii=False,
+        ).encode()
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_header.pack(MAGIC, VERSION, len(meta)))
+            f.write(meta)
+            f.writelines(blobs)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str | os.PathLike) -> "TagIndex":
+        """Memory-map an index written by `save()`. Tag bitmaps are decoded on first use."""
+        with open(path, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, meta_len = _header.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            buf.close()
+            raise ValueError(f"{path} is not a tag index (version {VERSION}).")
+
+        meta = json.loads(buf[_header.size : _header.size + meta_len])
+        base = _header.size + meta_len
+
+        index = cls()
+        index._mmap = buf
+        index._tags = {
+            name: (base + offset, length) for name, (offset, length) in meta["tags"].items()
+        }
+        offset, length = meta["posts"]
+        index.posts = Bitmap.from_buffer(buf[base + offset : base + offset + length])
+        for month, (offset, count) in meta["months"].items():
+            ids_at, days_at = base + offset, base + offset + 4 * count
+            index.months[month] = MonthPosts(
+                _le_array("I", buf[ids_at:days_at]),
+                _le_array("I", buf[days_at : days_at + 4 * count]),
+            )
+        # Missing from older files, every post is then checked again on the next update
+        index.last_post_id = meta.get("last_post_id", 0)
+        index.last_post_tag_id = meta["last_post_tag_id"]
+        return index
+
+    def close(self):
+        """Decode what is left and release the memory-mapped file."""
+        if self._mmap is not None:
+            for name in list(self._tags):
+                self.tag(name)
+            self._mmap.close()
+            self._mmap = None
+
+
+def update_from_sql(index: TagIndex, step: int = 10_000) -> TagIndex:
+    """
+    Add the posts and the post_tag rows inserted since the last update to `index`.
+    Every post is indexed, tagged or not, so date and `none_of` filters see the
+    same posts as in the Mongo index.
+    """
+    from sqlalchemy import select
+    from sqlalchemy.orm import Session
+    from sql_db.db_config import engine
+    from sql_db.models import Post, PostTag, Tag
+
+    post_stmt = select(Post.id, Post.created_at).order_by(Post.id.asc())
+    tag_stmt = (
+        select(PostTag.id, PostTag.post_id, Tag.name)
+        .join(Tag, Tag.id == PostTag.tag_id)
+        .order_by(PostTag.id.asc())
+    )
+
+    with Session(engine) as session:
+        while True:
+            stmt = post_stmt.where(Post.id > index.last_post_id).limit(step)
+
+            if not (rows := session.execute(stmt).all()):
+                break
+
+            for post_id, created_at in rows:
+                index.add(post_id, (), created_at)
+            index.last_post_id = post_id
+
+        while True:
+            stmt = tag_stmt.where(PostTag.id > index.last_post_tag_id).limit(step)
+
+            if not (rows := session.execute(stmt).all()):
+                break
+
+            for post_tag_id, post_id, name in rows:
+                index.add_tags(post_id, (name,))
+            index.last_post_tag_id = post_tag_id
+
+    return index
+
+
+def build_sql_index() -> TagIndex:
+    return update_from_sql(TagIndex())
+
+
+def build_mongo_index() -> TagIndex:
+    """Index of the Mongo schema, keyed by the posts' `sql_id`."""
+    import mongo_db  # noqa: F401
+    from mongo_db.models import Post
+
+    index = TagIndex()
+    posts = Post._get_collection().find(
+        {}, {"_id": False, "sql_id": True, "tags": True, "created_at": True}
+    )
+    for post in posts:
+        created_at: datetime = post["created_at"]
+        index.add(post["sql_id"], post.get("tags", ()), created_at)
+    return index
@@ -0,0 +1,263 @@
+"""
+Write-behind counter for post views.
+
+Instead of one `UPDATE posts SET views = views + 1` (or `$inc`) per page view,
+increments are summed in memory per post id and flushed in one batch, either
+every `interval` seconds or as soon as `max_pending` distinct posts are waiting.
+While flushes succeed, a hard crash loses at most that window; `close()` (also
+run at interpreter exit) flushes whatever is left.
+
+When the store is down, a failed batch is kept and retried as is, with
+exponential backoff, before any newer increment; only the part of it that was
+not applied when the store reports a partial failure (`FlushError`). The
+backlog is capped at `max_backlog` distinct posts: past it, increments of posts
+not already pending are dropped and counted in `dropped`. So are the increments
+`close()` still could not flush after `close_timeout` seconds of retries.
+
+    counter = ViewCounter(flush_sql, interval=1.0)
+    counter.incr(post_id)
+    ...
+    counter.close()
+
+Each counter writes to a single store, use one counter per schema to feed both.
+"""
+
+import atexit
+import logging
+import threading
+import time
+import uuid
+from collections import Counter
+from collections.abc import Callable, Mapping
+
+logger = logging.getLogger(__name__)
+
+# fmt: off
+# Posts updated by one SQL statement, keeps the CASE expression reasonably sized
+SQL_FLUSH_CHUNK    = 1000
+# Ids of the last batches applied to a Mongo post, see flush_mongo()
+VIEW_BATCHES_KEPT  = 4
+# fmt: on
+
+
+class Batch(Counter):
+    """
+    Increments of one flush. A failed batch is retried with the same `id`, and
+    before any newer batch, so stores can recognize the posts it already reached.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.id = uuid.uuid4().hex
+
+
+class FlushError(Exception):
+    """A batch was only partly applied, `failed` holds the increments left to apply."""
+
+    def __init__(self, message: str, failed: Mapping[int, int]):
+        super().__init__(message)
+        self.failed = failed
+
+
+def flush_sql(counts: Mapping[int, int]):
+    """Apply `{post id: increment}` with `UPDATE ... SET views = views + CASE id ... END`."""
+    from sqlalchemy import case, update
+    from sqlalchemy.orm import Session
+    from sql_db.db_config import engine
+    from sql_db.models import Post
+
+    # Sorted ids, so concurrent flushes lock rows in the same order
+    post_ids = sorted(counts)
+
+    with Session(engine) as session:
+        for idx in range(0, len(post_ids), SQL_FLUSH_CHUNK):
+            chunk = {pid: counts[pid] for pid in post_ids[idx : idx + SQL_FLUSH_CHUNK]}
+            stmt = (
+                update(Post)
+                .where(Post.id.in_(chunk))
+                .values(views=Post.views + case(chunk, value=Post.id, else_=0))
+            )
+            session.execute(stmt, execution_options={"synchronize_session": False})
+        session.commit()
+
+
+def flush_mongo(counts: Mapping[int, int]):
+    """
+    Apply `{post sql id: increment}` with a single unordered `bulk_write` of `$inc`.
+
+    An unordered bulk write can be partly applied when it fails. Every post keeps
+    the ids of the last batches applied to it and skips a batch it already has,
+    so retrying a batch after e.g. a network error does not count views twice.
+    Write errors are raised as `FlushError`, with only the increments that failed.
+    """
+    from pymongo import UpdateOne
+    from pymongo.errors import BulkWriteError
+    import mongo_db  # noqa: F401
+    from mongo_db.models import Post
+
+    batch = counts if isinstance(counts, Batch) else Batch(counts)
+    post_ids = list(batch)
+    ops = [
+        UpdateOne(
+            {"sql_id": pid, "view_batches": {"$ne": batch.id}},
+            {
+                "$inc": {"views": batch[pid]},
+                "$push": {"view_batches": {"$each": [batch.id], "$slice": -VIEW_BATCHES_KEPT}},
+            },
+        )
+        for pid in post_ids
+    ]
+
+    try:
+        Post._get_collection().bulk_write(ops, ordered=False)
+    except BulkWriteError as e:
+        if not (errors := e.details.get("writeErrors")):
+            # e.g. a write concern error, which does not tell what was applied
+            raise
+        failed = {post_ids[err["index"]]: batch[post_ids[err["index"]]] for err in errors}
+        raise FlushError(f"{len(failed)} of {len(batch)} post views failed", failed) from e
+
+
+class ViewCounter:
+    def __init__(
+        self,
+        flush_func: Callable[[Mapping[int, int]], None],
+        interval: float = 1.0,
+        max_pending: int = 1000,
+        max_backlog: int = 100_000,
+        max_backoff: float = 60.0,
+        close_timeout: float = 30.0,
+    ):
+        self.flush_func = flush_func
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_backlog = max_backlog
+        self.max_backoff = max_backoff
+        self.close_timeout = close_timeout
+        # Increments dropped because the backlog was full, or lost at close()
+        self.dropped = 0
+
+        self._pending: Counter = Counter()
+        # Batch being flushed, kept until it is applied
+        self._batch: Batch | None = None
+        self._lock = threading.Lock()
+        # Only one flush at a time, so a failed batch is retried before the next one
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = threading.Event()
+
+        self._thread = threading.Thread(
+            target=self._run, name="view-counter-flush", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.close)
+
+    def incr(self, post_id: int, n: int = 1):
+        with self._lock:
+            if self._closed.is_set():
+                raise RuntimeError("ViewCounter is closed")
+
+            size = len(self._pending)
+            backlog = size + len(self._batch or ())
+            if post_id not in self._pending and backlog >= self.max_backlog:
+                if not self.dropped:
+                    logger.warning("Post views backlog is full, dropping increments.")
+                self.dropped += n
+                return
+
+            self._pending[post_id] += n
+            size += 1
+
+        if size >= self.max_pending:
+            self._wakeup.set()
+
+    @property
+    def pending(self) -> int:
+        """Number of posts with increments not flushed yet."""
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        with self._flush_lock:
+            # A batch that failed last time first, then the increments since
+            for _ in range(2):
+                with self._lock:
+                    if self._batch is None:
+                        if not self._pending:
+                            return
+                        self._batch, self._pending = Batch(self._pending), Counter()
+                    batch = self._batch
+
+                try:
+                    self.flush_func(batch)
+                except FlushError as e:
+                    # Only the failed part is retried, under the same batch id
+                    with self._lock:
+                        batch.clear()
+                        batch.update(e.failed)
+                    raise
+
+                with self._lock:
+                    self._batch = None
+
+    def _next_backoff(self, backoff: float) -> float:
+        return min(max(backoff * 2, self.interval), self.max_backoff)
+
+    def _run(self):
+        backoff = 0.0
+
+        while not self._closed.is_set():
+            if backoff:
+                # Size triggers are ignored while backing off, only close() cuts it short
+                self._closed.wait(backoff)
+            else:
+                self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+            try:
+                self.flush()
+            except Exception:
+                backoff = self._next_backoff(backoff)
+                logger.exception(f"Failed to flush post views, retrying in {backoff}s.")
+            else:
+                backoff = 0.0
+
+    def close(self):
+        """
+        Stop the background flusher and flush what is left, retrying with backoff
+        for up to `close_timeout` seconds. What still fails is logged and dropped.
+        """
+        # Taken with the lock, so no increment can land after the final flush
+        with self._lock:
+            if self._closed.is_set():
+                return
+            self._closed.set()
+
+        self._wakeup.set()
+        self._thread.join()
+        atexit.unregister(self.close)
+
+        deadline = time.monotonic() + self.close_timeout
+        backoff = 0.0
+        while True:
+            try:
+                self.flush()
+                return
+            except Exception:
+                backoff = self._next_backoff(backoff)
+                if time.monotonic() + backoff > deadline:
+                    break
+                logger.exception(f"Failed to flush post views, retrying in {backoff}s.")
+                time.sleep(backoff)
+
+        with self._lock:
+            lost = sum(self._pending.values()) + sum((self._batch or {}).values())
+            self._pending, self._batch = Counter(), None
+            self.dropped += lost
+        logger.error(f"Failed to flush post views at close, {lost} views lost.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()